@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import numpy as np
 
 
@@ -23,7 +22,24 @@ def intersection_point(point1, point2) -> list[float]:
     return [intersection_x, intersection_y, intersection_z]
 
 
+def intersection_points(focal_points, points):
+    """
+    Batch version of `intersection_point` for many rays.
+    :param focal_points: (N, 3) ray origins
+    :param points: (N, K, 3) second point of every ray
+    :return: (N, K, 2) x, y of the intersections with the plain where z=0
+    """
+    focal_points = focal_points[:, None, :]
+    t = focal_points[..., 2] / (focal_points[..., 2] - points[..., 2])
+
+    return focal_points[..., :2] + t[..., None] * (
+        points[..., :2] - focal_points[..., :2]
+    )
+
+
 def plot_surface(points, figsize=(8, 6)):
+    import matplotlib.pyplot as plt  # debug plotting only, keep it off the import path
+
     fig = plt.figure(figsize=figsize)
     ax = fig.add_subplot(111, projection="3d")
 
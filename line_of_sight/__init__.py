@@ -1,38 +1,55 @@
-from .FOV import intersection_point, lat_lon_to_mm, mm_to_lat_lon
-from .sensor_position import calculate_rotated_points
+from typing import Optional
 
-REFERENCE_POINT = [32.835751, 34.606934]
+import numpy as np
+
+from .FOV import intersection_points
+from .projection import LocalProjection, get_local_projection
+from .sensor_position import calculate_rotated_points_array
 
 
 def get_fov_polygon(
-    sensor, angels: list[float], focal_point: list[float]
+    sensor,
+    angels: list[float],
+    focal_point: list[float],
+    projection: Optional[LocalProjection] = None,
 ) -> list[list[float]]:
-    azimuth, elevation = angels
+    return get_fov_polygons(sensor, [angels], [focal_point], projection)[0].tolist()
+
+
+def get_fov_polygons(
+    sensor, angels, focal_points, projection: Optional[LocalProjection] = None
+) -> np.ndarray:
+    """
+    Projects many camera poses on the ground at once.
 
-    focal_point_xy_mm = lat_lon_to_mm(
-        focal_point[0], focal_point[1], REFERENCE_POINT[0], REFERENCE_POINT[1]
+    :param sensor: The camera sensor
+    :param angels: (N, 2) array of (azimuth, elevation)
+    :param focal_points: (N, 3) array of (lat, lon, height in meters)
+    :param projection: The metric frame to work in, by default the one of the
+        region around the first focal point
+    :return: (N, 4, 2) array with the lat, lon corners of every footprint
+    """
+    angels = np.asarray(angels, dtype=float).reshape(-1, 2)
+    focal_points = np.asarray(focal_points, dtype=float).reshape(-1, 3)
+    if not len(focal_points):
+        return np.zeros((0, 4, 2))
+    if projection is None:
+        projection = get_local_projection(*focal_points[0, :2])
+
+    # x is east and y is north, all in mm like the sensor
+    focal_points_xyz_mm = (
+        np.column_stack([projection.project(focal_points[:, :2]), focal_points[:, 2]])
+        * 1000
     )
-    focal_point_xyz_mm = [
-        focal_point_xy_mm[1],
-        focal_point_xy_mm[0],
-        focal_point[2] * 1000,
-    ]  # lon is y and lat is x
 
-    a_rotated, b_rotated, c_rotated, d_rotated = calculate_rotated_points(
+    rotated = calculate_rotated_points_array(
         sensor.width_mm,
         sensor.height_mm,
         sensor.focal_length_mm,
-        azimuth,
-        elevation,
-        focal_point_xyz_mm,
+        angels[:, 0],
+        angels[:, 1],
+        focal_points_xyz_mm,
     )
-    intersections = []
-    for point in [a_rotated, b_rotated, c_rotated, d_rotated]:
-        intersection = intersection_point(focal_point_xyz_mm, point)
-        interaction_lat_lon = mm_to_lat_lon(
-            intersection[1], intersection[0], REFERENCE_POINT[0], REFERENCE_POINT[1]
-        )
-
-        intersections.append([*interaction_lat_lon])  # add z latter, curr z is 0
+    intersections = intersection_points(focal_points_xyz_mm, rotated)
 
-    return intersections
+    return projection.unproject(intersections / 1000)  # curr z is 0
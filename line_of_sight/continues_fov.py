@@ -1,20 +1,79 @@
 import numpy as np
-from scipy.spatial import ConvexHull
-
-
-def minimum_bounding_rectangle(points):
-    hull_points = points[ConvexHull(points).vertices]
-    return hull_points
 
 
 def flatten(xss):
     return [x for xs in xss for x in xs]
 
 
+def _cross(origins, a, b):
+    return (a[:, 0] - origins[:, 0]) * (b[:, 1] - origins[:, 1]) - (
+        a[:, 1] - origins[:, 1]
+    ) * (b[:, 0] - origins[:, 0])
+
+
+def _half_hulls(points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    One monotone chain pass over (N, K, 2) points, already sorted per row.
+    Every row keeps its own stack, and all rows are advanced together.
+    """
+    rows = np.arange(len(points))
+    stack = np.zeros(points.shape[:2], dtype=int)
+    size = np.zeros(len(points), dtype=int)
+
+    for k in range(points.shape[1]):
+        candidate = points[:, k]
+        while True:
+            can_pop = size >= 2
+            last = points[rows, stack[rows, np.maximum(size - 1, 0)]]
+            before_last = points[rows, stack[rows, np.maximum(size - 2, 0)]]
+            pop = can_pop & (_cross(before_last, last, candidate) <= 0)
+            if not pop.any():
+                break
+            size[pop] -= 1
+
+        stack[rows, size] = k
+        size += 1
+
+    return stack, size
+
+
+def calc_continues_fovs(fov_polygons) -> list[list[list[float]]]:
+    """
+    Convex hulls of many point sets at once, with Andrew's monotone chain.
+
+    :param fov_polygons: (N, K, 2) array, every row holding the footprint
+        corners swept during one sample
+    :return: N hulls, each a counterclockwise list of points
+    """
+    points = np.asarray(fov_polygons, dtype=float)
+    if not len(points):
+        return []
+    points = points.reshape(len(points), -1, 2)
+
+    order = np.lexsort((points[..., 1], points[..., 0]), axis=-1)
+    points = np.take_along_axis(points, order[..., None], axis=1)
+
+    lower, lower_size = _half_hulls(points)
+    upper, upper_size = _half_hulls(points[:, ::-1])
+
+    # The last point of each half is the first point of the other one
+    hulls = []
+    for row, reversed_row, lower_row, lower_count, upper_row, upper_count in zip(
+        points, points[:, ::-1], lower, lower_size, upper, upper_size
+    ):
+        hull = np.concatenate(
+            [
+                row[lower_row[: lower_count - 1]],
+                reversed_row[upper_row[: upper_count - 1]],
+            ]
+        )
+        hulls.append(hull.tolist())
+
+    return hulls
+
+
 def calc_continues_fov(
     fov_polygons: list[list[list[float]]],
 ) -> list[list[float]]:
     flattened = flatten(fov_polygons)
-    bounding_box = minimum_bounding_rectangle(np.array(flattened))
-
-    return bounding_box.tolist()
+    return calc_continues_fovs([flattened])[0]
@@ -0,0 +1,54 @@
+from functools import lru_cache
+
+import numpy as np
+from pyproj import CRS, Transformer
+
+# Region centers are snapped to this grid, so flights over the same region share one
+# cached projection. Within the ~55km to a center the scale error stays below 0.01%
+REGION_GRID_DEGREES = 0.5
+
+
+class LocalProjection:
+    """
+    Azimuthal equidistant projection centered on a region, in meters with x
+    to the east and y to the north. The pyproj transformers are built once
+    and transform whole coordinate arrays per call.
+    """
+
+    def __init__(self, center_lat: float, center_lon: float):
+        self.center = (center_lat, center_lon)
+        crs = CRS.from_proj4(
+            f"+proj=aeqd +lat_0={center_lat} +lon_0={center_lon} +datum=WGS84 +units=m"
+        )
+        self._to_local = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+        self._to_lat_lon = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+
+    def project(self, points) -> np.ndarray:
+        """(..., 2) lat/lon to (..., 2) east/north meters."""
+        points = np.asarray(points, dtype=float)
+        east, north = self._to_local.transform(points[..., 1], points[..., 0])
+        return np.stack([east, north], axis=-1)
+
+    def unproject(self, points) -> np.ndarray:
+        """(..., 2) east/north meters to (..., 2) lat/lon."""
+        points = np.asarray(points, dtype=float)
+        lon, lat = self._to_lat_lon.transform(points[..., 0], points[..., 1])
+        return np.stack([lat, lon], axis=-1)
+
+    def flat_distance_m(self, points_a, points_b) -> np.ndarray:
+        projected_a = self.project(np.asarray(points_a, dtype=float)[..., :2])
+        projected_b = self.project(np.asarray(points_b, dtype=float)[..., :2])
+        return np.linalg.norm(projected_a - projected_b, axis=-1)
+
+
+@lru_cache(maxsize=64)
+def _region_projection(center_lat: float, center_lon: float) -> LocalProjection:
+    return LocalProjection(center_lat, center_lon)
+
+
+def get_local_projection(lat: float, lon: float) -> LocalProjection:
+    """The cached projection of the region around (lat, lon)."""
+    return _region_projection(
+        round(lat / REGION_GRID_DEGREES) * REGION_GRID_DEGREES,
+        round(lon / REGION_GRID_DEGREES) * REGION_GRID_DEGREES,
+    )
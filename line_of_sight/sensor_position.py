@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import numpy as np
 
 
@@ -11,6 +10,8 @@ def plot_surface(points, figsize=(8, 6)):
         figsize: Optional, a tuple specifying the figure size (width, height) in inches.
     """
 
+    import matplotlib.pyplot as plt  # debug plotting only, keep it off the import path
+
     fig = plt.figure(figsize=figsize)
     ax = fig.add_subplot(111, projection="3d")
 
@@ -45,6 +46,8 @@ def plot_rotated_rectangle(points, figsize=(8, 6)):
         figsize: Optional, a tuple specifying the figure size (width, height) in inches.
     """
 
+    import matplotlib.pyplot as plt  # debug plotting only, keep it off the import path
+
     fig = plt.figure(figsize=figsize)
     ax = fig.add_subplot(111, projection="3d")
 
@@ -132,4 +135,53 @@ def calculate_rotated_points(W, H, FL, AZ, EL, focal_point):
     return A_rotated, B_rotated, C_rotated, D_rotated
 
 
+def calculate_rotated_points_array(W, H, FL, AZ, EL, focal_points):
+    """
+    Batch version of `calculate_rotated_points` for many camera poses.
+
+    Args:
+        W: Width of the rectangle.
+        H: Height of the rectangle.
+        FL: Distance from the focal point to the center of the rectangle.
+        AZ: (N,) rotation angles around the z-axis in degrees.
+        EL: (N,) rotation angles around the x-axis in degrees.
+        focal_points: (N, 3) array of focal point coordinates (x, y, z).
+
+    Returns:
+        (N, 4, 3) array with the final positions of points A, B, C and D.
+    """
+
+    half_W = W / 2
+    half_H = H / 2
+
+    # Points A, B, C, D relative to the focal point
+    corners = np.array(
+        [
+            [-half_W, FL, half_H],
+            [half_W, FL, half_H],
+            [half_W, FL, -half_H],
+            [-half_W, FL, -half_H],
+        ]
+    )
+
+    EL_rad = np.radians(np.asarray(EL, dtype=float))
+    AZ_rad = np.radians(np.asarray(AZ, dtype=float))
+    cos_el, sin_el = np.cos(EL_rad), np.sin(EL_rad)
+    cos_az, sin_az = np.cos(AZ_rad), np.sin(AZ_rad)
+
+    # R_z @ R_x for every pose, written out element by element
+    rotations = np.zeros((len(EL_rad), 3, 3))
+    rotations[:, 0, 0] = cos_az
+    rotations[:, 0, 1] = -sin_az * cos_el
+    rotations[:, 0, 2] = sin_az * sin_el
+    rotations[:, 1, 0] = sin_az
+    rotations[:, 1, 1] = cos_az * cos_el
+    rotations[:, 1, 2] = -cos_az * sin_el
+    rotations[:, 2, 1] = sin_el
+    rotations[:, 2, 2] = cos_el
+
+    rotated = np.einsum("nij,kj->nki", rotations, corners)
+    return rotated + np.asarray(focal_points, dtype=float)[:, None, :]
+
+
 # plot_rotated_rectangle([A_rotated, B_rotated, C_rotated, D_rotated])
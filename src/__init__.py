@@ -1,65 +1,126 @@
-import math
 import os.path
 from collections import OrderedDict
 from typing import Any, NamedTuple, Optional, Sequence, TypedDict
 
 import numpy as np
 import requests
-from geopy import distance
+import shapely
 from loguru import logger
-from pydantic import BaseModel, Field, model_validator
-from shapely.geometry import Polygon, box
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, model_validator
+from shapely.geometry import Polygon
 from typing_extensions import Self
 
-from line_of_sight import get_fov_polygon
+from line_of_sight import LocalProjection, get_fov_polygon, get_local_projection
+from src.geodesy import distance_m
 
 API_URL = "https://api.open-elevation.com/api/v1/lookup"
 
 
-def create_grid_polygons(polygon: Polygon | Any, cell_size: float):
+class DemandGrid:
+    """
+    Struct of arrays holding the grid cells of a demand.
+
+    centroids is an (N, 3) array of (lat, lon, alt), areas holds the clipped
+    cell geometries and gsd/los hold the running best GSD and line of sight
+    of every cell. The geometries and the spatial index over the centroids
+    never change, so snapshots share them and only copy the gsd/los arrays.
+    obstacles holds the (lat, lon, alt) of the terrain rising highest above
+    the ray to each cell at its last LOS evaluation, NaN where unknown, and is
+    not part of snapshots.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        areas: np.ndarray,
+        gsd: Optional[np.ndarray] = None,
+        los: Optional[np.ndarray] = None,
+        centroids_tree: Optional[shapely.STRtree] = None,
+    ):
+        self.centroids = centroids
+        self.areas = areas
+        self.centroids_tree = (
+            shapely.STRtree(shapely.points(centroids[:, :2]))
+            if centroids_tree is None
+            else centroids_tree
+        )
+        self.gsd = (
+            np.full(len(centroids), np.inf, dtype=np.float32) if gsd is None else gsd
+        )
+        self.los = np.zeros(len(centroids), dtype=bool) if los is None else los
+        self.obstacles = np.full((len(centroids), 3), np.nan)
+
+    def __len__(self) -> int:
+        return len(self.centroids)
+
+    def snapshot(self) -> "DemandGrid":
+        return DemandGrid(
+            self.centroids,
+            self.areas,
+            self.gsd.copy(),
+            self.los.copy(),
+            self.centroids_tree,
+        )
+
+    def centroids_within(self, polygon: shapely.Geometry) -> np.ndarray:
+        """Indices, in grid order, of the cells whose centroid the polygon contains."""
+        return np.sort(self.centroids_tree.query(polygon, predicate="contains"))
+
+    def reset(self) -> None:
+        self.gsd.fill(np.inf)
+        self.los.fill(False)
+        self.obstacles.fill(np.nan)
+
+    def to_dict(self) -> dict[tuple[float, float, float], dict[str, Any]]:
+        return {
+            tuple(centroid): {"area": area, "GSD": float(gsd), "LOS": bool(los)}
+            for centroid, area, gsd, los in zip(
+                self.centroids.tolist(), self.areas, self.gsd, self.los
+            )
+        }
+
+
+def create_grid_polygons(polygon: Polygon | Any, cell_size: float) -> DemandGrid:
     polygon = Polygon(polygon)
+    shapely.prepare(polygon)
 
     minx, miny, maxx, maxy = polygon.bounds
-    grid_polygons = {}
-
-    for x in np.arange(minx, maxx, cell_size):
-        for y in np.arange(miny, maxy, cell_size):
-            # Define the current cell as a polygon (box)
-            cell = box(x, y, x + cell_size, y + cell_size)
-
-            if cell.intersects(polygon):
-                # Clip the cell to the input polygon (to handle partial overlaps)
-                clipped_cell: Polygon = cell.intersection(polygon)
-                lat = clipped_cell.centroid.x
-                long = clipped_cell.centroid.y
-                [point_with_alt] = get_altitude([Point(lat, long)])
-                p_x, p_y, p_z = (
-                    point_with_alt.lat,
-                    point_with_alt.long,
-                    point_with_alt.alt,
-                )
-                grid_polygons[p_x, p_y, p_z] = {
-                    "area": clipped_cell,
-                    "GSD": float("inf"),
-                    "LOS": False,
-                }
-
-    return grid_polygons
+    xs, ys = np.meshgrid(
+        np.arange(minx, maxx, cell_size),
+        np.arange(miny, maxy, cell_size),
+        indexing="ij",
+    )
+    xs, ys = xs.ravel(), ys.ravel()
+
+    # Define every cell as a polygon (box) and keep the ones touching the polygon
+    cells = shapely.box(xs, ys, xs + cell_size, ys + cell_size)
+    cells = cells[shapely.intersects(polygon, cells)]
+
+    # Clip the cells to the input polygon (to handle partial overlaps)
+    clipped_cells = shapely.intersection(cells, polygon)
+    centroids = shapely.get_coordinates(shapely.centroid(clipped_cells))
+    altitudes = get_altitudes(centroids)
+
+    return DemandGrid(np.column_stack([centroids, altitudes]), clipped_cells)
 
 
 class Demand(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     id: str
     polygon: list[tuple[float, float]]
     allowed_azimuth: dict[str, float] = {"from": 0, "to": 360}
     allowed_elevation: dict[str, float] = {"from": -90, "to": 90}
+    # we will have to see which size is the appropriate cell size
+    cell_size: float = Field(default=0.015, gt=0)
 
-    demand_inner_calculation: Optional[dict[str, dict[str, Any | float | bool]]] = None
+    demand_inner_calculation: Optional[DemandGrid] = None
 
     @model_validator(mode="after")
     def prepare_demand(self) -> Self:
         self.demand_inner_calculation = create_grid_polygons(
-            self.polygon, 0.015
-        )  # we will have to see which size is the appropriate cell size
+            self.polygon, self.cell_size
+        )
         return self
 
 
@@ -107,23 +168,39 @@ class Sensor(BaseModel):
 def get_max_camera_capability(
     fov_polygon, focal_point: list[float, float, float]
 ) -> float:
-    curr_distance_in_meters = -1
-    for point in fov_polygon:
-        flat_distance = distance.distance(focal_point[:2], point).meters
-        euclidian_distance = math.sqrt(flat_distance**2 + (focal_point[2] - 0) ** 2)
-        curr_distance_in_meters = max(curr_distance_in_meters, euclidian_distance)
-    return curr_distance_in_meters
+    flat_distances = distance_m(focal_point[:2], fov_polygon)
+    euclidian_distances = np.sqrt(flat_distances**2 + (focal_point[2] - 0) ** 2)
+    return float(euclidian_distances.max(initial=-1))
 
 
 def calculate_gsd_in_cm(
     sensor: Sensor, focal_point: Sequence[float], point_in_surface: Sequence[float]
 ):
-    flat_distance = distance.distance(focal_point[:2], point_in_surface[:2]).meters
-    euclidian_distance = math.sqrt(
-        flat_distance**2 + (focal_point[2] - point_in_surface[2]) ** 2
+    return float(calculate_gsds_in_cm(sensor, focal_point, [point_in_surface])[0])
+
+
+def calculate_gsds_in_cm(
+    sensor: Sensor,
+    focal_point: Sequence[float],
+    points_in_surface,
+    projection: Optional[LocalProjection] = None,
+) -> np.ndarray:
+    """
+    GSD in cm from one focal point to every (lat, lon, alt) of an (N, 3) array.
+    The flat distances are geodesic, or measured in the given metric frame.
+    """
+    points_in_surface = np.asarray(points_in_surface, dtype=float).reshape(-1, 3)
+    if projection is None:
+        flat_distances = distance_m(focal_point[:2], points_in_surface[:, :2])
+    else:
+        flat_distances = projection.flat_distance_m(
+            focal_point[:2], points_in_surface[:, :2]
+        )
+    euclidian_distances = np.sqrt(
+        flat_distances**2 + (focal_point[2] - points_in_surface[:, 2]) ** 2
     )
 
-    GSD = (euclidian_distance * sensor.width_mm) / (
+    GSD = (euclidian_distances * sensor.width_mm) / (
         sensor.focal_length_mm * sensor.image_width_px
     )
     return GSD * 100
@@ -145,6 +222,22 @@ class Flight(BaseModel):
     gsd: Optional[float] = None
     fov_polygon: Optional[list[list[float]]] = None
 
+    _path_index: Any = PrivateAttr(default=None)
+
+    def get_path_index(self):
+        from src.path_index import FlightPathIndex  # TODO: prevent circular imports
+
+        if self._path_index is None:
+            self._path_index = FlightPathIndex(
+                self.path_case, self.speed_km_h, self.get_projection()
+            )
+        return self._path_index
+
+    def get_projection(self) -> LocalProjection:
+        """The metric frame shared by all of this flight's computations."""
+        center_lat, center_lon = np.mean(np.asarray(self.path, dtype=float), axis=0)[:2]
+        return get_local_projection(center_lat, center_lon)
+
     def get_relative_azimuth_to_flight_direction(
         self, p1: tuple[float] | list, p2: tuple[float] | list
     ) -> float:
@@ -170,7 +263,10 @@ class Flight(BaseModel):
 
         focal_point = [*self.path[0], self.height_meters]
         fov_polygon = get_fov_polygon(
-            self.sensor, [self.camera_azimuth, self.camera_elevation_start], focal_point
+            self.sensor,
+            [self.camera_azimuth, self.camera_elevation_start],
+            focal_point,
+            self.get_projection(),
         )
         # self.gsd = calculate_gsd_in_cm(self.sensor, fov_polygon, focal_point)
         self.camera_capability_meters = get_max_camera_capability(
@@ -215,11 +311,16 @@ class LRUCache:
     def __init__(self, capacity: int = 10):
         self.cache = OrderedDict()
         self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def get(self, key):
         if key not in self.cache:
+            self.misses += 1
             return None
         else:
+            self.hits += 1
             self.cache.move_to_end(key)
             return self.cache[key]
 
@@ -229,13 +330,114 @@ class LRUCache:
         self.cache[key] = value
         if len(self.cache) > self.capacity:
             self.cache.popitem(last=False)
+            self.evictions += 1
+
+    def evict(self, key):
+        if key in self.cache:
+            self.evictions += 1
+        return self.cache.pop(key, None)
+
+    def clear(self):
+        self.evictions += len(self.cache)
+        self.cache.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self.cache),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
 
 
 def read_hgt_file(filename):
     logger.info(f"hgt file name {filename}")
-    with open(filename, "rb") as f:
-        elevation_data = np.fromfile(f, np.dtype(">i2"), -1).reshape((3601, 3601))
-    return elevation_data
+    return np.memmap(filename, np.dtype(">i2"), mode="r", shape=(3601, 3601))
+
+
+class HgtTileStore:
+    """
+    Process wide store of memory mapped HGT tiles.
+
+    A tile is mapped once and kept in a bounded LRU, so repeated lookups do
+    not touch the disk again. Since the tiles are mapped read only, worker
+    processes on the same host share the OS page cache instead of each one
+    holding its own copy of the tile.
+    """
+
+    def __init__(self, capacity: int = 20):
+        self.tiles = LRUCache(capacity=capacity)
+        self.pyramids = LRUCache(capacity=capacity)
+        self.missing_files: set[str] = set()
+
+    def get_tile(self, hgt_file: str) -> Optional[np.ndarray]:
+        elevation_data = self.tiles.get(hgt_file)
+        if elevation_data is not None:
+            return elevation_data
+
+        if hgt_file in self.missing_files:
+            return None
+        if not os.path.isfile(hgt_file):
+            self.missing_files.add(hgt_file)
+            return None
+
+        elevation_data = read_hgt_file(hgt_file)
+        self.tiles.put(hgt_file, elevation_data)
+        return elevation_data
+
+    def get_pyramid(self, hgt_file: str) -> Optional[list[np.ndarray]]:
+        """The max elevation pyramid of the tile, built on first use."""
+        pyramid = self.pyramids.get(hgt_file)
+        if pyramid is not None:
+            return pyramid
+
+        elevation_data = self.get_tile(hgt_file)
+        if elevation_data is None:
+            return None
+
+        pyramid = build_max_pyramid(elevation_data)
+        self.pyramids.put(hgt_file, pyramid)
+        return pyramid
+
+    def evict(self, hgt_file: str) -> None:
+        self.tiles.evict(hgt_file)
+        self.pyramids.evict(hgt_file)
+        self.missing_files.discard(hgt_file)
+
+    def clear(self) -> None:
+        self.tiles.clear()
+        self.pyramids.clear()
+        self.missing_files.clear()
+
+    def stats(self) -> dict[str, int]:
+        return self.tiles.stats()
+
+
+def build_max_pyramid(elevation_data: np.ndarray) -> list[np.ndarray]:
+    """
+    Max mip levels of a tile. Level 0 is the tile itself and every post of
+    level l + 1 holds the highest of the 2x2 posts under it in level l, so a
+    post of level l bounds a block of 2^l x 2^l posts of the tile.
+    """
+    pyramid = [elevation_data]
+    while max(pyramid[-1].shape) > 1:
+        level = pyramid[-1]
+        rows, cols = level.shape
+        padded = np.full(
+            (rows + rows % 2, cols + cols % 2), np.iinfo(np.int16).min, dtype=np.int16
+        )
+        padded[:rows, :cols] = level
+        pyramid.append(
+            np.maximum(
+                np.maximum(padded[0::2, 0::2], padded[0::2, 1::2]),
+                np.maximum(padded[1::2, 0::2], padded[1::2, 1::2]),
+            )
+        )
+    return pyramid
+
+
+HGT_TILE_STORE = HgtTileStore(capacity=20)
 
 
 def get_elevation(lat, lon, elevation_data):
@@ -244,25 +446,202 @@ def get_elevation(lat, lon, elevation_data):
     return elevation_data[lat_row, lon_row]
 
 
-def get_altitude(points, hgt_files_directory="hgt"):
-    loaded_hgt = LRUCache(capacity=20)  # Adjust capacity as needed
-    elevation_result = []
+def get_elevation_array(
+    lats: np.ndarray, lons: np.ndarray, elevation_data, interpolate: bool = False
+) -> np.ndarray:
+    """
+    Array version of `get_elevation` for points that all lie in the same tile.
+    With `interpolate` the four surrounding posts are blended bilinearly
+    instead of taking the post the point falls on.
+    """
+    lat_rows = (1 - (lats - np.trunc(lats))) * 3600
+    lon_rows = (lons - np.trunc(lons)) * 3600
+    if not interpolate:
+        return elevation_data[lat_rows.astype(int), lon_rows.astype(int)].astype(float)
+
+    row = np.minimum(lat_rows.astype(int), 3599)
+    col = np.minimum(lon_rows.astype(int), 3599)
+    row_weight = lat_rows - row
+    col_weight = lon_rows - col
+
+    top = (1 - col_weight) * elevation_data[row, col]
+    top += col_weight * elevation_data[row, col + 1]
+    bottom = (1 - col_weight) * elevation_data[row + 1, col]
+    bottom += col_weight * elevation_data[row + 1, col + 1]
+    return (1 - row_weight) * top + row_weight * bottom
+
+
+def get_altitudes(
+    coordinates, hgt_files_directory="hgt", interpolate: bool = False
+) -> np.ndarray:
+    """
+    Array in / array out elevation lookup.
+
+    Parameters:
+        coordinates (array_like): (N, 2) array of (lat, lon) points.
+        hgt_files_directory (str): Directory holding the HGT tiles.
+        interpolate (bool): Bilinear interpolation between the DEM posts.
+    Returns:
+        np.ndarray: N altitudes in meters, 0 where no tile is available.
+    """
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+    lats, lons = coordinates[:, 0], coordinates[:, 1]
+    altitudes = np.zeros(len(coordinates))
+    if not len(coordinates):
+        return altitudes
+
+    tiles, tile_of_point = np.unique(
+        np.trunc(coordinates).astype(int), axis=0, return_inverse=True
+    )
+    tile_of_point = tile_of_point.reshape(-1)
 
-    for point in points:
-        try:
-            lat, lon = point.lat, point.long
-        except AttributeError:
-            lat, lon = (point[0], point[1])
-        hgt_file = f"{hgt_files_directory}/N{int(lat):02d}E{int(lon):03d}.hgt"
-        if not os.path.isfile(hgt_file):
-            elevation_result.append(0.0)
-            continue
-        elevation_data = loaded_hgt.get(hgt_file)
+    for tile_index, (tile_lat, tile_lon) in enumerate(tiles):
+        hgt_file = f"{hgt_files_directory}/N{tile_lat:02d}E{tile_lon:03d}.hgt"
+        elevation_data = HGT_TILE_STORE.get_tile(hgt_file)
         if elevation_data is None:
-            elevation_data = read_hgt_file(hgt_file)
-            loaded_hgt.put(hgt_file, elevation_data)
+            continue
+
+        in_tile = tile_of_point == tile_index
+        altitudes[in_tile] = get_elevation_array(
+            lats[in_tile], lons[in_tile], elevation_data, interpolate
+        )
 
-        elevation_result.append(get_elevation(lat, lon, elevation_data))
+    return altitudes
+
+
+def get_dem_indices(lats, lons) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Global indices of the DEM posts `get_elevation` reads for the points.
+
+    A post is counted in arcseconds from the equator and from the prime
+    meridian, so the post (north, east) lies at (north / 3600, east / 3600)
+    whatever tile it is read from.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    lat_tiles = np.trunc(lats)
+    lon_tiles = np.trunc(lons)
+    rows = ((1 - (lats - lat_tiles)) * 3600).astype(int)
+    cols = ((lons - lon_tiles) * 3600).astype(int)
+    return (
+        lat_tiles.astype(int) * 3600 + 3600 - rows,
+        lon_tiles.astype(int) * 3600 + cols,
+    )
+
+
+def get_elevation_window(
+    north_min: int,
+    north_max: int,
+    east_min: int,
+    east_max: int,
+    hgt_files_directory="hgt",
+) -> np.ndarray:
+    """
+    The DEM posts between the given global indices (see `get_dem_indices`),
+    stitched across tiles.
+
+    Returns:
+        np.ndarray: (north_max - north_min + 1, east_max - east_min + 1)
+        altitudes in meters, north up like the tiles, 0 where no tile is
+        available.
+    """
+    window = np.zeros((north_max - north_min + 1, east_max - east_min + 1))
+
+    # Tile t holds the norths (t * 3600, t * 3600 + 3600] in its rows 3599..0
+    for tile_lat in range((north_min - 1) // 3600, (north_max - 1) // 3600 + 1):
+        for tile_lon in range(east_min // 3600, east_max // 3600 + 1):
+            hgt_file = f"{hgt_files_directory}/N{tile_lat:02d}E{tile_lon:03d}.hgt"
+            elevation_data = HGT_TILE_STORE.get_tile(hgt_file)
+            if elevation_data is None:
+                continue
+
+            top = min(north_max, tile_lat * 3600 + 3600)
+            bottom = max(north_min, tile_lat * 3600 + 1)
+            left = max(east_min, tile_lon * 3600)
+            right = min(east_max, tile_lon * 3600 + 3599)
+            window[
+                north_max - top : north_max - bottom + 1,
+                left - east_min : right - east_min + 1,
+            ] = elevation_data[
+                tile_lat * 3600 + 3600 - top : tile_lat * 3600 + 3600 - bottom + 1,
+                left - tile_lon * 3600 : right - tile_lon * 3600 + 1,
+            ]
+
+    return window
+
+
+def get_max_altitudes(
+    north_min, north_max, east_min, east_max, hgt_files_directory="hgt"
+) -> np.ndarray:
+    """
+    Upper bound of the DEM posts in every box of global post indices (see
+    `get_dem_indices`), read from the max pyramids of the tiles.
+
+    A box is bounded by the 2x2 blocks of the first pyramid level whose blocks
+    are at least as large as the box, so the bound is exact for a single post
+    and only grows with the size of the box. Boxes that span several tiles
+    are not bounded (inf).
+    """
+    north_min, north_max, east_min, east_max = np.broadcast_arrays(
+        *[
+            np.asarray(index, dtype=int)
+            for index in (north_min, north_max, east_min, east_max)
+        ]
+    )
+    bounds = np.full(north_min.shape, np.inf)
+
+    # Tile t holds the norths (t * 3600, t * 3600 + 3600] in its rows 3599..0
+    tile_lats = (north_min - 1) // 3600
+    tile_lons = east_min // 3600
+    in_one_tile = ((north_max - 1) // 3600 == tile_lats) & (
+        east_max // 3600 == tile_lons
+    )
+    if not in_one_tile.any():
+        return bounds
+
+    extents = np.maximum(north_max - north_min, east_max - east_min) + 1
+    levels = np.ceil(np.log2(extents)).astype(int)
+
+    tiles, tile_of_box = np.unique(
+        np.stack([tile_lats[in_one_tile], tile_lons[in_one_tile]], axis=-1),
+        axis=0,
+        return_inverse=True,
+    )
+    boxes = np.flatnonzero(in_one_tile)
+    for tile_index, (tile_lat, tile_lon) in enumerate(tiles):
+        in_tile = boxes[tile_of_box.reshape(-1) == tile_index]
+        hgt_file = f"{hgt_files_directory}/N{tile_lat:02d}E{tile_lon:03d}.hgt"
+        pyramid = HGT_TILE_STORE.get_pyramid(hgt_file)
+        if pyramid is None:
+            bounds[in_tile] = 0
+            continue
+
+        top_rows = tile_lat * 3600 + 3600 - north_max[in_tile]
+        bottom_rows = tile_lat * 3600 + 3600 - north_min[in_tile]
+        left_cols = east_min[in_tile] - tile_lon * 3600
+        right_cols = east_max[in_tile] - tile_lon * 3600
+        box_levels = levels[in_tile]
+        for level in np.unique(box_levels).tolist():
+            at_level = box_levels == level
+            blocks = pyramid[level]
+            top, bottom = top_rows[at_level] >> level, bottom_rows[at_level] >> level
+            left, right = left_cols[at_level] >> level, right_cols[at_level] >> level
+            bounds[in_tile[at_level]] = np.maximum.reduce(
+                [
+                    blocks[top, left],
+                    blocks[top, right],
+                    blocks[bottom, left],
+                    blocks[bottom, right],
+                ]
+            )
+
+    return bounds
+
+
+def get_altitude(points, hgt_files_directory="hgt"):
+    elevation_result = get_altitudes(
+        [(point[0], point[1]) for point in points], hgt_files_directory
+    )
 
     points_result = []
     for point, elevation in zip(points, elevation_result):
@@ -0,0 +1,71 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional
+
+from src import Demand, Flight
+from src.logic import calculate_accesses_for_demands, create_case_for_flight_path
+
+
+class CalculationResult(NamedTuple):
+    flights: list[Flight]
+    base_cases: dict[str, list[dict]]  # flight id -> casing of the flight
+    accesses_for_demands: dict[
+        str, dict[str, list]
+    ]  # demand id -> flight id -> accesses
+
+
+def compute_accesses(flights: list[Flight], demands: list[Demand]) -> CalculationResult:
+    base_cases = {}
+    accesses_for_demands = {demand.id: {} for demand in demands}
+    for flight in flights:
+        base_case = create_case_for_flight_path(flight)
+        base_cases[flight.id] = base_case
+
+        accesses = calculate_accesses_for_demands(flight, base_case, demands)
+        for demand, accesses_for_demand in zip(demands, accesses):
+            accesses_for_demands[demand.id][flight.id] = accesses_for_demand
+
+    return CalculationResult(flights, base_cases, accesses_for_demands)
+
+
+def _calculate_accesses_for_batch(flight_case_demands):
+    flight, base_case, demands = flight_case_demands
+    return calculate_accesses_for_demands(flight, base_case, demands)
+
+
+def parallel_compute_accesses(
+    flights: list[Flight],
+    demands: list[Demand],
+    max_workers: Optional[int] = None,
+    chunksize: int = 1,
+) -> CalculationResult:
+    """
+    Same result as `compute_accesses`, computed in a process pool. The demands
+    of every flight are split in about one batch per worker, and every batch
+    is a single pass over the flight path. The HGT tiles are memory mapped,
+    so the workers share them through the page cache.
+    """
+    batch_count = min(max_workers or os.cpu_count() or 1, len(demands)) or 1
+    demand_batches = [demands[index::batch_count] for index in range(batch_count)]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        base_cases = list(executor.map(create_case_for_flight_path, flights))
+        batches = [
+            (flight, base_case, demand_batch)
+            for flight, base_case in zip(flights, base_cases)
+            for demand_batch in demand_batches
+        ]
+        results = list(
+            executor.map(_calculate_accesses_for_batch, batches, chunksize=chunksize)
+        )
+
+    accesses_for_demands = {demand.id: {} for demand in demands}
+    for (flight, _, demand_batch), accesses in zip(batches, results):
+        for demand, accesses_for_demand in zip(demand_batch, accesses):
+            accesses_for_demands[demand.id][flight.id] = accesses_for_demand
+
+    return CalculationResult(
+        flights,
+        {flight.id: base_case for flight, base_case in zip(flights, base_cases)},
+        accesses_for_demands,
+    )
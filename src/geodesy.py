@@ -0,0 +1,38 @@
+"""
+Vectorized geodesy on the WGS-84 ellipsoid.
+
+Every function takes (N, 2) arrays of (lat, lon) in degrees, or a single
+(lat, lon) that is broadcast against the others, and solves the geodesic
+problems in one pyproj call instead of one geopy call per pair. The results
+are the same geodesics geopy computes, to well under a millimeter.
+"""
+
+import numpy as np
+from pyproj import Geod
+
+WGS84 = Geod(ellps="WGS84")
+
+
+def _lat_lon(*points) -> list[np.ndarray]:
+    points = [np.asarray(point, dtype=float)[..., :2] for point in points]
+    return np.broadcast_arrays(*points)
+
+
+def distance_m(points_a, points_b) -> np.ndarray:
+    """Geodesic distance in meters between every pair of points."""
+    points_a, points_b = _lat_lon(points_a, points_b)
+    _, _, distances = WGS84.inv(
+        points_a[..., 1], points_a[..., 0], points_b[..., 1], points_b[..., 0]
+    )
+    return np.asarray(distances)
+
+
+def interpolate(points_a, points_b, fractions) -> np.ndarray:
+    """
+    Points at the given fractions between a and b, linear in lat/lon like the
+    rest of the sampling code. Over the few kilometers between samples this is
+    within meters of the geodesic.
+    """
+    points_a, points_b = _lat_lon(points_a, points_b)
+    fractions = np.asarray(fractions, dtype=float)[..., None]
+    return points_a + fractions * (points_b - points_a)
@@ -1,25 +1,39 @@
 import datetime
-from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
+from typing import Optional, Sequence
 
 import numpy as np
-from geopy.distance import geodesic
-from shapely.geometry import Point, Polygon
-
-from line_of_sight import get_fov_polygon
-from line_of_sight.continues_fov import calc_continues_fov
-from src import Demand, Flight, calculate_gsd_in_cm, get_altitude
+import shapely
+from shapely.geometry import Polygon
+
+from line_of_sight import LocalProjection, get_fov_polygons, get_local_projection
+from line_of_sight.continues_fov import calc_continues_fovs
+from src import (
+    Demand,
+    Flight,
+    calculate_gsds_in_cm,
+    get_altitudes,
+    get_dem_indices,
+    get_max_altitudes,
+)
 from src.coverage import calculate_intersection_raw, convert_polygon_to_list
+from src.geodesy import distance_m, interpolate
+from src.los_kernels import NUMBA_AVAILABLE, march_rays_compiled
+from src.viewshed import compute_viewshed, viewshed_window_posts
 
+# Every post of a viewshed window costs ~200 bytes of temporaries, larger
+# windows are marched ray by ray even with `use_viewshed`
+VIEWSHED_MAX_POSTS = 1_000_000
+# From this many ray samples in total, the pyramid traversal pays for its steps
+PYRAMID_MIN_SAMPLES = 5000
+# A cell stays blocked without a new ray while the terrain under the new ray
+# next to its last obstacle comes within this many meters of the ray. At 0 the
+# LOS is the same as marching every ray again
+LOS_REUSE_TOLERANCE_M = 0.0
 
-def get_intersectioncentroids(demand: Demand, intersection: Polygon):
-    # Iterate over every area and see if the centroid of the area is inside the polygon
-    intersection_centroids = []
-    for centroid in demand.demand_inner_calculation.keys():
-        if intersection.contains(Point(centroid[:2])):
-            intersection_centroids.append(centroid)
 
-    return intersection_centroids
+def get_intersectioncentroids(demand: Demand, intersection: Polygon) -> np.ndarray:
+    # Query the demand's centroid index for the centroids inside the polygon
+    return demand.demand_inner_calculation.centroids_within(intersection)
 
 
 def get_z_value_from_line(p1, p2, x, y):
@@ -56,55 +70,315 @@ def get_z_value_from_line(p1, p2, x, y):
 def put_best_GSD_into_demand(
     demand: Demand, flight: Flight, point_with_alt: list[float], related_centroids: list
 ) -> None:
-    for related_centroid in related_centroids:
-        gsd = calculate_gsd_in_cm(flight.sensor, point_with_alt, related_centroid)
-        if demand.demand_inner_calculation[related_centroid]["GSD"] > gsd:
-            demand.demand_inner_calculation[related_centroid]["GSD"] = gsd
-
-
-def calculate_los_for_centroid(demand, point_with_alt, related_centroid):
-    if demand.demand_inner_calculation[related_centroid]["LOS"]:
-        return related_centroid, True
-
-    points_on_line = points_along_line(
-        point_with_alt[0],
-        point_with_alt[1],
-        related_centroid[0],
-        related_centroid[1],
-        350,
-    )
-    len_points_on_line = len(points_on_line)
-    points_array = np.array(points_on_line)
-
-    equation_alts = np.apply_along_axis(
-        lambda point: get_z_value_from_line(
-            point_with_alt, related_centroid, point[0], point[1]
-        ),
-        1,
-        points_array,
+    grid = demand.demand_inner_calculation
+    related_centroids = np.asarray(related_centroids, dtype=int)
+    gsds = calculate_gsds_in_cm(
+        flight.sensor,
+        point_with_alt,
+        grid.centroids[related_centroids],
+        flight.get_projection(),
     )
+    grid.gsd[related_centroids] = np.minimum(grid.gsd[related_centroids], gsds)
+
+
+def _num_segments(
+    observer: np.ndarray,
+    centroids: np.ndarray,
+    interval_distance: int,
+    projection: Optional[LocalProjection],
+) -> np.ndarray:
+    """How many samples the ray to every centroid is marched with."""
+    if projection is None:
+        ray_lengths = distance_m(observer[:2], centroids[:, :2])
+    else:
+        ray_lengths = projection.flat_distance_m(observer[:2], centroids[:, :2])
+    return np.maximum((ray_lengths / interval_distance).astype(int), 1)
+
+
+def calculate_los_for_centroids(
+    point_with_alt: Sequence[float],
+    centroids,
+    interval_distance: int = 350,
+    projection: Optional[LocalProjection] = None,
+    hierarchical: Optional[bool] = None,
+    return_obstacles: bool = False,
+):
+    """
+    Calculates the line of sight from one observer to many centroids at once.
 
-    real_points = get_altitude(points_on_line)
-    real_alts = np.array([point[2] for point in real_points])
+    Every ray is sampled every `interval_distance` meters. The ray height at
+    each sample is linear in the sample fraction, so it is computed in closed
+    form. When numba is installed the rays are marched by the compiled
+    kernel of `src.los_kernels`. Otherwise large batches are tested
+    hierarchically against the max elevation pyramid of the tiles, see
+    `march_rays_over_pyramid`, and small ones as one (rays, samples) array
+    against the terrain under every sample, which costs less than the
+    traversal steps there. All of them give the same result.
 
-    if np.any(real_alts >= equation_alts):
-        return related_centroid, False
+    Parameters:
+        point_with_alt (array_like): The observer (lat, lon, alt).
+        centroids (array_like): (N, 3) array of (lat, lon, alt) targets.
+        interval_distance (int): Sampling step along each ray in meters.
+        projection (LocalProjection): Metric frame the ray lengths are measured
+            in, geodesic lengths when not given.
+        hierarchical (bool): Force the NumPy pyramid traversal on or off, by
+            default the compiled kernel is used when available and the
+            pyramid from PYRAMID_MIN_SAMPLES samples otherwise.
+        return_obstacles (bool): Also return the terrain blocking every ray.
+    Returns:
+        np.ndarray: N booleans, True where the centroid is visible.
+        np.ndarray: With `return_obstacles`, (N, 3) array of the (lat, lon,
+            alt) of the sample rising highest above every blocked ray, NaN for
+            the visible centroids.
+    """
+    observer = np.asarray(point_with_alt, dtype=float)
+    centroids = np.asarray(centroids, dtype=float).reshape(-1, 3)
+    if not len(centroids):
+        visible, obstacles = np.zeros(0, dtype=bool), np.zeros((0, 3))
+        return (visible, obstacles) if return_obstacles else visible
 
-    return related_centroid, True
+    num_segments = _num_segments(observer, centroids, interval_distance, projection)
 
+    if hierarchical is None and NUMBA_AVAILABLE:
+        march_rays = march_rays_compiled
+    else:
+        if hierarchical is None:
+            hierarchical = num_segments.sum() >= PYRAMID_MIN_SAMPLES
+        march_rays = march_rays_over_pyramid if hierarchical else march_rays_densely
+    blocked, obstacles = march_rays(observer, centroids, num_segments)
 
-def put_LOS_into_demand(demand, point_with_alt, related_centroids):
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(
-                calculate_los_for_centroid, demand, point_with_alt, centroid
-            )
-            for centroid in related_centroids
+    return (~blocked, obstacles) if return_obstacles else ~blocked
+
+
+def march_rays_densely(
+    observer: np.ndarray, centroids: np.ndarray, num_segments: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Which rays hit the terrain at one of their samples 0..num_segments - 1,
+    testing all samples of all rays as one (rays, samples) array.
+
+    Returns:
+        np.ndarray: N booleans, True where the ray is blocked.
+        np.ndarray: (N, 3) array of the sample rising highest above each
+            blocked ray, NaN for the others.
+    """
+    # The target itself lies on the terrain, so only the samples before it count
+    steps = np.arange(num_segments.max())
+    on_ray = steps[None, :] < num_segments[:, None]
+    t = steps[None, :] / num_segments[:, None]
+
+    delta = centroids - observer
+    sample_lats = observer[0] + t * delta[:, 0, None]
+    sample_lons = observer[1] + t * delta[:, 1, None]
+    ray_alts = observer[2] + t * delta[:, 2, None]
+
+    terrain_alts = np.zeros(on_ray.shape)
+    terrain_alts[on_ray] = get_altitudes(
+        np.stack([sample_lats[on_ray], sample_lons[on_ray]], axis=-1)
+    )
+    clearances = np.where(on_ray, ray_alts - terrain_alts, np.inf)
+    blocked = (clearances <= 0).any(axis=1)
+
+    obstacles = np.full((len(centroids), 3), np.nan)
+    rays = np.flatnonzero(blocked)
+    samples = clearances[rays].argmin(axis=1)
+    obstacles[rays] = np.column_stack(
+        [
+            sample_lats[rays, samples],
+            sample_lons[rays, samples],
+            terrain_alts[rays, samples],
         ]
-        for future in futures:
-            related_centroid, los_status = future.result()
-            if los_status:
-                demand.demand_inner_calculation[related_centroid]["LOS"] = True
+    )
+    return blocked, obstacles
+
+
+def _ray_samples(observer: np.ndarray, delta: np.ndarray, t: np.ndarray):
+    """The DEM post (north, east) under every ray sample and the ray height there."""
+    norths, easts = get_dem_indices(
+        observer[0] + t * delta[:, 0], observer[1] + t * delta[:, 1]
+    )
+    return norths, easts, observer[2] + t * delta[:, 2]
+
+
+def march_rays_over_pyramid(
+    observer: np.ndarray, centroids: np.ndarray, num_segments: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Which rays hit the terrain at one of their samples 0..num_segments - 1.
+
+    Every ray starts as a single run of samples. A run whose lowest point is
+    above the highest terrain in the DEM box around it is clear as a whole,
+    the others are split in two, down to single samples where the bound is
+    the terrain under the sample itself. Rays that pass high above the
+    terrain are decided in a few coarse steps, and a ray is dropped as soon
+    as one of its samples is blocked. The blocked rays are then marched
+    densely, to report the same obstacles as `march_rays_densely`.
+
+    Returns:
+        np.ndarray: N booleans, True where the ray is blocked.
+        np.ndarray: (N, 3) array of the sample rising highest above each
+            blocked ray, NaN for the others.
+    """
+    delta = centroids - observer
+    blocked = np.zeros(len(centroids), dtype=bool)
+    obstacles = np.full((len(centroids), 3), np.nan)
+
+    # The runs [firsts, lasts] of samples still to decide, and their ray
+    rays = np.arange(len(centroids))
+    firsts = np.zeros(len(centroids), dtype=int)
+    lasts = num_segments - 1
+    while len(rays):
+        first_norths, first_easts, first_alts = _ray_samples(
+            observer, delta[rays], firsts / num_segments[rays]
+        )
+        last_norths, last_easts, last_alts = _ray_samples(
+            observer, delta[rays], lasts / num_segments[rays]
+        )
+
+        # The samples are on a straight line, so the box of its ends holds them all
+        terrain_bounds = get_max_altitudes(
+            np.minimum(first_norths, last_norths),
+            np.maximum(first_norths, last_norths),
+            np.minimum(first_easts, last_easts),
+            np.maximum(first_easts, last_easts),
+        )
+        may_hit = terrain_bounds >= np.minimum(first_alts, last_alts)
+
+        single = firsts == lasts
+        blocked[rays[may_hit & single]] = True
+        split = may_hit & ~single & ~blocked[rays]
+
+        rays, firsts, lasts = rays[split], firsts[split], lasts[split]
+        middles = (firsts + lasts) // 2
+        rays = np.concatenate([rays, rays])
+        firsts = np.concatenate([firsts, middles + 1])
+        lasts = np.concatenate([middles, lasts])
+
+    if blocked.any():
+        _, obstacles[blocked] = march_rays_densely(
+            observer, centroids[blocked], num_segments[blocked]
+        )
+    return blocked, obstacles
+
+
+def obstacles_still_block(
+    point_with_alt,
+    centroids: np.ndarray,
+    obstacles: np.ndarray,
+    tolerance_m: float,
+    projection: Optional[LocalProjection] = None,
+    interval_distance: int = 350,
+) -> np.ndarray:
+    """
+    Which centroids are still hidden from a new observer by the obstacle that
+    blocked them before, without marching their rays again.
+
+    The new ray is sampled as `calculate_los_for_centroids` samples it, but
+    only at its two samples around the old obstacle. When the terrain under
+    one of them reaches the ray, the full march is blocked there too. With a
+    `tolerance_m` the terrain may also stay up to that many meters under the
+    ray, so a centroid may stay hidden when its ray clears the terrain there
+    by less than that.
+
+    Parameters:
+        point_with_alt (array_like): The new observer (lat, lon, alt).
+        centroids (np.ndarray): (N, 3) array of (lat, lon, alt) targets.
+        obstacles (np.ndarray): (N, 3) array of the (lat, lon, alt) that
+            blocked every target, NaN where unknown.
+        tolerance_m (float): Clearance in meters still counted as blocked.
+        projection (LocalProjection): Metric frame the ray lengths are measured
+            in, as for `calculate_los_for_centroids`.
+        interval_distance (int): Sampling step along each ray in meters.
+    Returns:
+        np.ndarray: N booleans, True where the centroid is still hidden.
+    """
+    observer = np.asarray(point_with_alt, dtype=float)
+    still_blocked = np.zeros(len(centroids), dtype=bool)
+    known = ~np.isnan(obstacles[:, 0])
+    if not known.any():
+        return still_blocked
+
+    targets = centroids[known]
+    num_segments = _num_segments(observer, targets, interval_distance, projection)
+
+    # Where the old obstacle falls along the new ray
+    frame = projection or get_local_projection(*observer[:2])
+    origin = frame.project(observer[:2])
+    rays = frame.project(targets[:, :2]) - origin
+    to_obstacles = frame.project(obstacles[known, :2]) - origin
+    fractions = (to_obstacles * rays).sum(axis=-1) / np.maximum(
+        (rays**2).sum(axis=-1), 1e-12
+    )
+
+    steps = np.floor(fractions * num_segments)[:, None] + np.arange(2)
+    on_ray = (steps >= 0) & (steps < num_segments[:, None])
+    t = steps / num_segments[:, None]
+
+    delta = targets - observer
+    sample_lats = observer[0] + t * delta[:, 0, None]
+    sample_lons = observer[1] + t * delta[:, 1, None]
+    ray_alts = observer[2] + t * delta[:, 2, None]
+
+    terrain_alts = np.full(on_ray.shape, -np.inf)
+    terrain_alts[on_ray] = get_altitudes(
+        np.stack([sample_lats[on_ray], sample_lons[on_ray]], axis=-1)
+    )
+    still_blocked[known] = (terrain_alts >= ray_alts - tolerance_m).any(axis=1)
+    return still_blocked
+
+
+def put_LOS_into_demand(
+    demand,
+    point_with_alt,
+    related_centroids,
+    projection: Optional[LocalProjection] = None,
+    use_viewshed: bool = False,
+    reuse_tolerance_m: Optional[float] = LOS_REUSE_TOLERANCE_M,
+):
+    """
+    Marks the cells visible from the observer.
+
+    Cells that were already seen are skipped, and so are the cells whose last
+    obstacle still blocks them within `reuse_tolerance_m`, see
+    `obstacles_still_block`. With `reuse_tolerance_m=None` every cell that was
+    not seen yet is marched again.
+
+    The other cells get a ray each, see `calculate_los_for_centroids`. With
+    `use_viewshed` they share one viewshed sweep instead, see `src.viewshed`,
+    unless its window, which always spans the observer too, has more than
+    VIEWSHED_MAX_POSTS posts. The sweep tests the terrain at every post rather
+    than every 350 meters, so it does not give the same LOS as the rays.
+    """
+    grid = demand.demand_inner_calculation
+    related_centroids = np.asarray(related_centroids, dtype=int)
+    pending_centroids = related_centroids[~grid.los[related_centroids]]
+    if reuse_tolerance_m is not None and len(pending_centroids):
+        still_blocked = obstacles_still_block(
+            point_with_alt,
+            grid.centroids[pending_centroids],
+            grid.obstacles[pending_centroids],
+            reuse_tolerance_m,
+            projection,
+        )
+        pending_centroids = pending_centroids[~still_blocked]
+    if not len(pending_centroids):
+        return
+
+    centroids = grid.centroids[pending_centroids]
+    bounds = [*centroids[:, :2].min(axis=0), *centroids[:, :2].max(axis=0)]
+    if (
+        use_viewshed
+        and viewshed_window_posts(point_with_alt, bounds) <= VIEWSHED_MAX_POSTS
+    ):
+        viewshed = compute_viewshed(point_with_alt, bounds)
+        los_statuses = viewshed.is_visible(centroids)
+        obstacles = np.nan
+    else:
+        los_statuses, obstacles = calculate_los_for_centroids(
+            point_with_alt, centroids, projection=projection, return_obstacles=True
+        )
+    grid.los[pending_centroids[los_statuses]] = True
+    grid.obstacles[pending_centroids] = obstacles
 
 
 def calculate_arrival_time(
@@ -114,59 +388,34 @@ def calculate_arrival_time(
     Calculates the estimated arrival time at a specific point on a flight route.
 
     Args:
-        polyline (list): A list of latitude/longitude tuples representing the flight path.
+        flight (Flight): The flight, its path_case is the route.
         start_time_iso (str): The starting time of the flight in ISO 8601 format (e.g., "2024-03-20T12:00:00Z").
         target_point (tuple): The latitude/longitude coordinates of the target point on the flight route.
-        avg_speed (float, optional): The average speed of the aircraft in kilometers per hour. Defaults to 500.
-        margin_of_error (float, optional): A margin of error (in minutes) to account for potential deviations. Defaults to 10.
+        margin_of_error (float, optional): A margin of error (in minutes) to account for potential deviations. Defaults to 5.
 
     Returns:
         datetime.datetime: The estimated arrival time at the target point.
 
     Raises:
-        ValueError: If the target point is not found on the polyline.
+        ValueError: If the flight route has less than two points.
     """
-
-    start_time = datetime.datetime.fromisoformat(start_time_iso)
-    closest_segment_index = None
-    closest_distance = float("inf")
-    for i in range(len(flight.path_case) - 1):
-        p1 = flight.path_case[i]
-        p2 = flight.path_case[i + 1]
-        distance = distance_to_segment(target_point, p1, p2)
-        if distance < closest_distance:
-            closest_segment_index = i
-            closest_distance = distance
-
-    if closest_segment_index is None:
-        raise ValueError("Target point not found on the polyline")
-
-    total_distance = 0
-    for i in range(closest_segment_index + 1):
-        total_distance += geodesic(flight.path_case[i], flight.path_case[i + 1]).km
-
-    estimated_travel_time = total_distance / flight.speed_km_h
-
-    estimated_arrival_time = start_time + datetime.timedelta(
-        hours=estimated_travel_time, minutes=margin_of_error
+    [estimated_arrival_time] = calculate_arrival_times(
+        flight, start_time_iso, [target_point[:2]], margin_of_error
     )
-
     return estimated_arrival_time
 
 
-def distance_to_segment(point, p1, p2):
+def calculate_arrival_times(
+    flight: Flight, start_time_iso, target_points, margin_of_error=5
+) -> list[datetime.datetime]:
     """
-    Calculates the distance from a point to a line segment.
+    Vectorized `calculate_arrival_time` for an array of points, the arrival
+    time at each point is the time the flight reaches the closest position
+    to it along its route.
     """
-
-    u = (
-        (point[0] - p1[0]) * (p2[0] - p1[0]) + (point[1] - p1[1]) * (p2[1] - p1[1])
-    ) / ((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2)
-    if u < 0 or u > 1:
-        return min(geodesic(point, p1).km, geodesic(point, p2).km)
-    x = p1[0] + u * (p2[0] - p1[0])
-    y = p1[1] + u * (p2[1] - p1[1])
-    return geodesic(point, (x, y)).km
+    return flight.get_path_index().arrival_times(
+        start_time_iso, target_points, margin_of_error
+    )
 
 
 def points_along_line(lat1, lon1, lat2, lon2, interval_distance):
@@ -175,60 +424,57 @@ def points_along_line(lat1, lon1, lat2, lon2, interval_distance):
     at specified intervals.
     """
     # Calculate total distance between two points in meters
-    total_distance = geodesic((lat1, lon1), (lat2, lon2)).meters
+    total_distance = float(distance_m((lat1, lon1), (lat2, lon2)))
 
     # Calculate the number of segments
     num_segments = int(total_distance / interval_distance)
 
-    # Calculate the fraction to divide the latitude and longitude differences by
-    lat_diff = lat2 - lat1
-    lon_diff = lon2 - lon1
-    lat_fraction = lat_diff / num_segments
-    lon_fraction = lon_diff / num_segments
-
     # Generate points at specified intervals
-    points = [
-        (lat1 + i * lat_fraction, lon1 + i * lon_fraction) for i in range(num_segments)
-    ]
+    fractions = np.arange(num_segments) * (1 / num_segments)
+    points = interpolate((lat1, lon1), (lat2, lon2), fractions).tolist()
+    points = [tuple(point) for point in points]
     points.insert(0, (lat1, lon1))
     points.insert(len(points) - 1, (lat2, lon2))
     return points
 
 
 def create_case_for_flight_path(flight: Flight):
+    path = np.asarray(flight.path, dtype=float)
+    azimuths = [
+        flight.get_relative_azimuth_to_flight_direction(
+            flight.path[i], flight.path[i + 1]
+        )
+        for i in range(len(flight.path) - 1)
+    ]
+
+    # Per segment: both ends of the segment at the start and at the end elevation
+    segment_ends = np.stack([path[:-1], path[1:], path[:-1], path[1:]], axis=1)
+    focal_points = np.concatenate(
+        [segment_ends, np.full((*segment_ends.shape[:2], 1), flight.height_meters)],
+        axis=-1,
+    )
+    elevations = [
+        flight.camera_elevation_start,
+        flight.camera_elevation_start,
+        flight.camera_elevation_end,
+        flight.camera_elevation_end,
+    ]
+    angels = np.stack(
+        np.broadcast_arrays(np.array(azimuths)[:, None], np.array(elevations)), axis=-1
+    )
+    fov_polygons = get_fov_polygons(
+        flight.sensor,
+        angels.reshape(-1, 2),
+        focal_points.reshape(-1, 3),
+        flight.get_projection(),
+    ).reshape(len(azimuths), 16, 2)
+    continues_fovs = calc_continues_fovs(fov_polygons)
+
     casing = []
-    for i in range(len(flight.path) - 1):
+    for i, continues_fov in enumerate(continues_fovs):
         first_point = flight.path[i]
         second_point = flight.path[i + 1]
 
-        azimuth = flight.get_relative_azimuth_to_flight_direction(
-            first_point, second_point
-        )
-        fov_polygon1 = get_fov_polygon(
-            flight.sensor,
-            [azimuth, flight.camera_elevation_start],
-            [*first_point, flight.height_meters],
-        )
-        fov_polygon2 = get_fov_polygon(
-            flight.sensor,
-            [azimuth, flight.camera_elevation_start],
-            [*second_point, flight.height_meters],
-        )
-
-        fov_polygon3 = get_fov_polygon(
-            flight.sensor,
-            [azimuth, flight.camera_elevation_end],
-            [*first_point, flight.height_meters],
-        )
-        fov_polygon4 = get_fov_polygon(
-            flight.sensor,
-            [azimuth, flight.camera_elevation_end],
-            [*second_point, flight.height_meters],
-        )
-
-        continues_fov = calc_continues_fov(
-            [fov_polygon1, fov_polygon2, fov_polygon3, fov_polygon4]
-        )
         casing.append(
             {
                 "points": {f"{i}": first_point, f"{i + 1}": second_point},
@@ -239,15 +485,41 @@ def create_case_for_flight_path(flight: Flight):
     return casing
 
 
-def get_intersection_with_case(casing, demand: Demand):
-    intersects_with_case = []
-    for case in casing:
-        _, intersection, _ = calculate_intersection_raw(
-            case["case_polygon"], demand.polygon
+class CasingIndex:
+    """
+    STRtree over the case polygons of one flight. Answers which segments of
+    the flight a whole batch of demands intersect with one bulk query, no
+    overlay is computed for that.
+    """
+
+    def __init__(self, casing: list[dict]):
+        self.casing = casing
+        self.tree = shapely.STRtree([Polygon(case["case_polygon"]) for case in casing])
+
+    def query(self, demands: list[Demand]) -> tuple[np.ndarray, np.ndarray]:
+        """(demand index, case index) of every intersecting pair, sorted by both."""
+        demand_polygons = np.array(
+            [Polygon(demand.polygon) for demand in demands], dtype=object
         )
-        if not intersection:
-            continue
-        intersects_with_case.append(case["points"])
+        demand_indices, case_indices = self.tree.query(
+            demand_polygons, predicate="intersects"
+        )
+        order = np.lexsort((case_indices, demand_indices))
+        return demand_indices[order], case_indices[order]
+
+    def intersecting_segments(self, demands: list[Demand]) -> list[list[dict]]:
+        """For every demand, the points of the segments intersecting it, in order."""
+        demand_indices, case_indices = self.query(demands)
+        intersects_with_case = [[] for _ in demands]
+        for demand_index, case_index in zip(
+            demand_indices.tolist(), case_indices.tolist()
+        ):
+            intersects_with_case[demand_index].append(self.casing[case_index]["points"])
+        return intersects_with_case
+
+
+def get_intersection_with_case(casing, demand: Demand):
+    [intersects_with_case] = CasingIndex(casing).intersecting_segments([demand])
     return intersects_with_case
 
 
@@ -281,29 +553,56 @@ def calculate_accesses_with_case_intersections(
     return accesses_for_flight
 
 
+def calculate_continues_fovs_along_points(points, flight: Flight, azimuth) -> list:
+    """The footprint swept between the start and end elevation at every point."""
+    # The start and end elevation footprints of every point, in one batch
+    focal_points = [[*point, flight.height_meters] for point in points]
+    fov_polygons = get_fov_polygons(
+        flight.sensor,
+        [[azimuth, flight.camera_elevation_start]] * len(points)
+        + [[azimuth, flight.camera_elevation_end]] * len(points),
+        focal_points + focal_points,
+        flight.get_projection(),
+    ).reshape(2, len(points), 4, 2)
+    return calc_continues_fovs(
+        fov_polygons.transpose(1, 0, 2, 3).reshape(len(points), 8, 2)
+    )
+
+
 def calculate_accesses_along_points(
     points, flight: Flight, demand: Demand, azimuth, elevation_sampling_rate: int = 1
 ):
+    continues_fovs = calculate_continues_fovs_along_points(points, flight, azimuth)
+    return calculate_accesses_from_fovs(points, continues_fovs, flight, demand)
+
+
+def calculate_accesses_from_fovs(
+    points,
+    continues_fovs,
+    flight: Flight,
+    demand: Demand,
+    sample_indices=None,
+    use_viewshed: bool = False,
+):
+    """
+    Accesses of one demand from footprints that were already computed.
+
+    :param sample_indices: The indices of the points whose footprint may
+        intersect the demand, by default all of them
+    :param use_viewshed: Compute the LOS with viewshed sweeps instead of rays,
+        see `put_LOS_into_demand`
+    """
     accesses = []
-    demand_gsd_and_los_init_val = deepcopy(demand.demand_inner_calculation)
+    grid = demand.demand_inner_calculation
+    projection = flight.get_projection()
+    if sample_indices is None:
+        sample_indices = range(len(points))
 
-    for index, point in enumerate(points):
-        fov_polygon_start_elevation = get_fov_polygon(
-            flight.sensor,
-            [azimuth, flight.camera_elevation_start],
-            [*point, flight.height_meters],
-        )
-        fov_polygon_end_elevation = get_fov_polygon(
-            flight.sensor,
-            [azimuth, flight.camera_elevation_end],
-            [*point, flight.height_meters],
-        )
-        continues_fov = calc_continues_fov(
-            [fov_polygon_start_elevation, fov_polygon_end_elevation]
-        )
+    for index in sample_indices:
+        point = points[index]
 
         coverage_percent, intersection, leftover = calculate_intersection_raw(
-            continues_fov, demand.polygon
+            continues_fovs[index], demand.polygon
         )
         if not intersection:
             continue
@@ -312,7 +611,13 @@ def calculate_accesses_along_points(
         put_best_GSD_into_demand(
             demand, flight, [*point, flight.height_meters], related_centroids
         )
-        put_LOS_into_demand(demand, [*point, flight.height_meters], related_centroids)
+        put_LOS_into_demand(
+            demand,
+            [*point, flight.height_meters],
+            related_centroids,
+            projection,
+            use_viewshed,
+        )
 
         current_access = {
             "point": point,
@@ -327,15 +632,75 @@ def calculate_accesses_along_points(
         else:  # The access is a continues from the last one
             accesses[-1][index] = current_access
 
-    demand_gsd_and_los = demand.demand_inner_calculation
-    demand.demand_inner_calculation = demand_gsd_and_los_init_val
+    # Hand out the results of this pass and leave the demand clean for the next one
+    demand_gsd_and_los = grid.snapshot()
+    grid.reset()
     return accesses, demand_gsd_and_los
 
 
 def calculate_accesses_for_demand(flight: Flight, base_case, demand: Demand):
-    demand_intersection_with_case = get_intersection_with_case(base_case, demand)
-    accesses_for_demand = calculate_accesses_with_case_intersections(
-        demand_intersection_with_case, flight, demand, resolution_in_meters=600
-    )
-
+    [accesses_for_demand] = calculate_accesses_for_demands(flight, base_case, [demand])
     return accesses_for_demand
+
+
+def calculate_accesses_for_demands(
+    flight: Flight,
+    base_case,
+    demands: list[Demand],
+    resolution_in_meters: int = 600,
+    use_viewshed: bool = False,
+) -> list[list]:
+    """
+    The accesses of every demand from one flight, in a single pass over the
+    flight path.
+
+    The footprints along every segment are computed once, whatever the number
+    of demands, and matched with an STRtree of the demand polygons. Only the
+    demands hit by a footprint go through the overlay, GSD and LOS of that
+    sample. Gives the same accesses as `calculate_accesses_with_case_intersections`
+    per demand.
+
+    With `use_viewshed` the LOS of every sample comes from a viewshed sweep
+    instead of rays, see `put_LOS_into_demand`.
+    """
+    demand_indices, case_indices = CasingIndex(base_case).query(demands)
+    demands_tree = shapely.STRtree([Polygon(demand.polygon) for demand in demands])
+
+    accesses_for_demands = [[] for _ in demands]
+    for case_index in np.unique(case_indices).tolist():
+        segment_points = base_case[case_index]["points"]
+        (index_A, point_A), (index_B, point_B) = segment_points.items()
+        azimuth = flight.get_relative_azimuth_to_flight_direction(point_A, point_B)
+        points = points_along_line(
+            point_A[0], point_A[1], point_B[0], point_B[1], resolution_in_meters
+        )
+        continues_fovs = [
+            Polygon(continues_fov)
+            for continues_fov in calculate_continues_fovs_along_points(
+                points, flight, azimuth
+            )
+        ]
+        sample_indices, hit_demands = demands_tree.query(
+            np.array(continues_fovs, dtype=object), predicate="intersects"
+        )
+
+        for demand_index in demand_indices[case_indices == case_index].tolist():
+            demand = demands[demand_index]
+            accesses_for_line, LOS_GSD = calculate_accesses_from_fovs(
+                points,
+                continues_fovs,
+                flight,
+                demand,
+                np.sort(sample_indices[hit_demands == demand_index]).tolist(),
+                use_viewshed,
+            )
+            accesses_for_demands[demand_index].append(
+                {
+                    f"{index_A},{index_B}": accesses_for_line,
+                    "LOS_GSD": LOS_GSD,
+                    "flight_id": flight.id,
+                    "demand_id": demand.id,
+                }
+            )
+
+    return accesses_for_demands
@@ -0,0 +1,119 @@
+"""
+Compiled LOS ray march, used when numba is installed.
+
+Every ray is marched sample by sample in one loop with the DEM index math of
+`get_elevation` inlined, so no (rays, samples) arrays are allocated. The loop
+goes on past the first blocked sample, to report the sample rising highest
+above the ray like `march_rays_densely` does. The rays are spread over all
+cores with `prange` on numba's workqueue threading layer, since the TBB and
+OpenMP layers do not survive the fork of the workers in `src.calculation`.
+The workqueue layer is not thread safe, so the kernel runs under a lock.
+
+Without numba the same functions run as plain Python, which is only useful
+for checking them, and `NUMBA_AVAILABLE` is False so the NumPy marches in
+`src.logic` are used instead.
+"""
+
+import math
+import os
+import threading
+
+import numpy as np
+
+from src import get_dem_indices, get_elevation_window
+
+try:
+    import numba
+    from numba import njit, prange
+
+    if "NUMBA_THREADING_LAYER" not in os.environ:
+        numba.config.THREADING_LAYER = "workqueue"
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+
+# Held while the parallel kernel runs
+_KERNEL_LOCK = threading.Lock()
+
+
+@njit(cache=True)
+def _elevation_at(window, north_max, east_min, lat, lon):
+    # The post `get_elevation` reads, see `get_dem_indices`
+    lat_tile = math.trunc(lat)
+    lon_tile = math.trunc(lon)
+    north = int(lat_tile) * 3600 + 3600 - int((1 - (lat - lat_tile)) * 3600)
+    east = int(lon_tile) * 3600 + int((lon - lon_tile) * 3600)
+    return window[north_max - north, east - east_min]
+
+
+@njit(parallel=True, cache=True)
+def _march_rays_kernel(
+    observer, centroids, num_segments, window, north_max, east_min, blocked, obstacles
+):
+    for ray in prange(len(centroids)):
+        delta_lat = centroids[ray, 0] - observer[0]
+        delta_lon = centroids[ray, 1] - observer[1]
+        delta_alt = centroids[ray, 2] - observer[2]
+        highest = 0.0
+        for step in range(num_segments[ray]):
+            t = step / num_segments[ray]
+            lat = observer[0] + t * delta_lat
+            lon = observer[1] + t * delta_lon
+            terrain_alt = _elevation_at(window, north_max, east_min, lat, lon)
+            above_ray = terrain_alt - (observer[2] + t * delta_alt)
+            if above_ray >= 0 and (not blocked[ray] or above_ray > highest):
+                blocked[ray] = True
+                highest = above_ray
+                obstacles[ray, 0] = lat
+                obstacles[ray, 1] = lon
+                obstacles[ray, 2] = terrain_alt
+
+
+def march_rays_compiled(
+    observer: np.ndarray, centroids: np.ndarray, num_segments: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Which rays hit the terrain at one of their samples 0..num_segments - 1.
+
+    The rays are straight in lat/lon, so the DEM window around the observer
+    and the centroids holds all their samples. It is read once and handed to
+    the kernel.
+
+    Returns:
+        np.ndarray: N booleans, True where the ray is blocked.
+        np.ndarray: (N, 3) array of the sample rising highest above each
+            blocked ray, NaN for the others.
+    """
+    blocked = np.zeros(len(centroids), dtype=bool)
+    obstacles = np.full((len(centroids), 3), np.nan)
+    if not len(centroids):
+        return blocked, obstacles
+
+    lats = np.append(centroids[:, 0], observer[0])
+    lons = np.append(centroids[:, 1], observer[1])
+    norths, easts = get_dem_indices(
+        np.array([lats.min(), lats.max()]), np.array([lons.min(), lons.max()])
+    )
+    north_min, north_max = int(norths.min()), int(norths.max())
+    east_min, east_max = int(easts.min()), int(easts.max())
+    window = get_elevation_window(north_min, north_max, east_min, east_max)
+
+    with _KERNEL_LOCK:
+        _march_rays_kernel(
+            observer.astype(float),
+            centroids.astype(float),
+            num_segments.astype(np.int64),
+            window,
+            north_max,
+            east_min,
+            blocked,
+            obstacles,
+        )
+    return blocked, obstacles
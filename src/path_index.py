@@ -0,0 +1,71 @@
+import datetime
+from typing import Sequence
+
+import numpy as np
+import shapely
+
+from line_of_sight.projection import LocalProjection
+from src.geodesy import distance_m
+
+
+class FlightPathIndex:
+    """
+    Along-track index of a flight path, built once per flight.
+
+    Holds the cumulative geodesic distance at every vertex, and the segments of
+    the path in the flight's projection in an STRtree, so the closest segment
+    to a point is found in O(log n). The projection is only used to find where
+    a point falls on the path, the distances themselves stay geodesic.
+    """
+
+    def __init__(
+        self,
+        path: Sequence[Sequence[float]],
+        speed_km_h: float,
+        projection: LocalProjection,
+    ):
+        self.vertices = np.asarray(path, dtype=float)[:, :2]
+        if len(self.vertices) < 2:
+            raise ValueError("A flight path needs at least two points")
+        self.speed_km_h = speed_km_h
+        self.projection = projection
+
+        self.segment_km = distance_m(self.vertices[:-1], self.vertices[1:]) / 1000
+        self.cumulative_km = np.concatenate([[0.0], np.cumsum(self.segment_km)])
+
+        self.projected = projection.project(self.vertices)
+        self.segments_tree = shapely.STRtree(
+            shapely.linestrings(
+                np.stack([self.projected[:-1], self.projected[1:]], axis=1)
+            )
+        )
+
+    def along_track_km(self, points) -> np.ndarray:
+        """Distance flown until the closest position on the path to every point."""
+        projected = self.projection.project(
+            np.asarray(points, dtype=float).reshape(-1, 2)
+        )
+        # Ties go to the earliest segment, the first time the flight is there
+        point_indices, segment = self.segments_tree.query_nearest(
+            shapely.points(projected), all_matches=True
+        )
+        order = np.lexsort((segment, point_indices))
+        first = np.unique(point_indices[order], return_index=True)[1]
+        segment = segment[order[first]]
+
+        starts = self.projected[segment]
+        segments = self.projected[segment + 1] - starts
+        lengths_squared = np.maximum((segments**2).sum(axis=-1), 1e-12)
+        fractions = ((projected - starts) * segments).sum(axis=-1) / lengths_squared
+        fractions = np.clip(fractions, 0, 1)
+        return self.cumulative_km[segment] + fractions * self.segment_km[segment]
+
+    def arrival_times(
+        self, start_time_iso: str, points, margin_of_error: float = 5
+    ) -> list[datetime.datetime]:
+        start_time = datetime.datetime.fromisoformat(start_time_iso)
+        travel_hours = self.along_track_km(points) / self.speed_km_h
+        return [
+            start_time + datetime.timedelta(hours=hours, minutes=margin_of_error)
+            for hours in travel_hours.tolist()
+        ]
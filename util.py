@@ -1,18 +1,20 @@
 import uuid
-from copy import deepcopy
+from typing import Optional
 
 import branca
 import folium
+import numpy as np
 from shapely import Polygon
 
 from map import Map
 from plot import generate_plots_base64_with_gsd_text
-from src import Demand, Flight
-from src.logic import (
-    calculate_accesses_for_demand,
-    calculate_arrival_time,
-    create_case_for_flight_path,
+from src import Demand, DemandGrid, Flight
+from src.calculation import (
+    CalculationResult,
+    compute_accesses,
+    parallel_compute_accesses,
 )
+from src.logic import calculate_arrival_times
 
 
 def add_demand(demand: Demand):
@@ -43,7 +45,9 @@ def show_demand_detail(res: dict, fligths, demands):
                         los_gsd_obj = access["LOS_GSD"]
                         if is_empty(los_gsd_obj):
                             continue
-                        base64_plots = generate_plots_base64_with_gsd_text(los_gsd_obj)
+                        base64_plots = generate_plots_base64_with_gsd_text(
+                            los_gsd_obj.to_dict()
+                        )
                         encoded_images.append(base64_plots)
 
                 for i, encoded_image in enumerate(encoded_images, start=1):
@@ -88,99 +92,111 @@ def draw_base_caseing_on_map(polygons, Map: folium.Map):
         ).add_to(Map)
 
 
-def calculation(flights: list[Flight], demands: list[Demand]):
-    accesses_for_demands = {}
-    for flight in flights:
-        accesses_along_a_fligth_path = []
-        base_case = create_case_for_flight_path(flight)
+ACCESS_METADATA_KEYS = ("LOS_GSD", "flight_id", "demand_id")
+
+
+def draw_accesses_on_map(flight: Flight, accesses_along_a_fligth_path, Map: folium.Map):
+    for accesses_for_demand in accesses_along_a_fligth_path:
+        for accesses_for_line in accesses_for_demand:
+            for line, accesses in accesses_for_line.items():
+                if line in ACCESS_METADATA_KEYS:
+                    continue
+                for access in accesses:
+                    access_points = list(access.values())
+                    start_time_iso = "2024-03-20T10:00:00Z"
+                    # Arrival at the first and the last access point, in one lookup
+                    start_time_access, end_time_access = calculate_arrival_times(
+                        flight,
+                        start_time_iso,
+                        [access_points[0]["point"], access_points[-1]["point"]],
+                    )
+                    for index, access_point in enumerate(access_points):
+                        point = access_point["point"]
+                        intersection = access_point["intersection"]
+
+                        if index == len(access_points) - 1:  # last access
+                            html = """
+                                <h1>Access</h1><br>
+                                    <ul>\n
+                                """
+
+                            style = "<br/>~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ <br/>"
+                            access_start = (
+                                f"{style}<li>Start: {str(start_time_access)}<br/>"
+                            )
+                            access_end = f"<li>end: {str(end_time_access)}<br/>"
+                            html += access_start + access_end
+
+                            html += "</ul>"
+                            # kw = {
+                            #     "prefix": "fa",
+                            #     "color": "pink",
+                            #     "icon": "card",
+                            # }
+                            # icon_angle = 270
+                            # icon = folium.Icon(angle=icon_angle, **kw)
+                            # folium.Marker(
+                            #     location=point,
+                            #     icon=icon,
+                            #     popup=html,
+                            #     color="pink",
+                            # ).add_to(Map)
+
+                        kwargs = {"color": "red"}
+                        intersection_centroid = Polygon(intersection).centroid
+                        if (
+                            intersection_centroid
+                        ):  # TODO: take a deep look when this shit happens
+                            intersection_centroid = [
+                                intersection_centroid.x,
+                                intersection_centroid.y,
+                            ]
+
+                        folium.PolyLine(
+                            [intersection_centroid, point],
+                            tooltip=f"coverage percentage: {access_point['coverage_percent']}",
+                            opacity=0.3,
+                            **kwargs,
+                        ).add_to(Map)
+
+                        folium.Polygon(
+                            locations=intersection,
+                            weight=0.3,
+                            fill_opacity=0.01,
+                            fill=True,
+                            **kwargs,
+                        ).add_to(Map)
+
+
+def render_calculation(result: CalculationResult, Map: folium.Map):
+    for flight in result.flights:
+        base_case = result.base_cases[flight.id]
         draw_base_caseing_on_map((case["case_polygon"] for case in base_case), Map)
 
-        for demand in demands:
-            accesses = calculate_accesses_for_demand(flight, base_case, demand)
-            accesses_for_demands[demand.id] = deepcopy(
-                {**accesses_for_demands.get(demand.id, {}), flight.id: accesses}
-            )
-            accesses_along_a_fligth_path.append(accesses)
-
-        # Drawing on map:
-        for accesses_for_demand in accesses_along_a_fligth_path:
-            for accesses_for_line in accesses_for_demand:
-                del accesses_for_line["LOS_GSD"]
-                del accesses_for_line["flight_id"]
-                del accesses_for_line["demand_id"]
-                for line, accesses in accesses_for_line.items():
-                    for access in accesses:
-                        start_time_access = None
-                        end_time_access = None
-                        for index, access_point in enumerate(access.values()):
-                            start_time_iso = "2024-03-20T10:00:00Z"
-                            point = access_point["point"]
-                            intersection = access_point["intersection"]
-
-                            if index == 0:  # first access
-                                start_time_access = calculate_arrival_time(
-                                    flight, start_time_iso, point
-                                )
-
-                            if index == len(list(access.values())) - 1:  # last access
-                                end_time_access = calculate_arrival_time(
-                                    flight, start_time_iso, point
-                                )
-
-                                html = """
-                                    <h1>Access</h1><br>
-                                        <ul>\n
-                                    """
-
-                                style = "<br/>~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ <br/>"
-                                access_start = (
-                                    f"{style}<li>Start: {str(start_time_access)}<br/>"
-                                )
-                                access_end = f"<li>end: {str(end_time_access)}<br/>"
-                                html += access_start + access_end
-
-                                html += "</ul>"
-                                # kw = {
-                                #     "prefix": "fa",
-                                #     "color": "pink",
-                                #     "icon": "card",
-                                # }
-                                # icon_angle = 270
-                                # icon = folium.Icon(angle=icon_angle, **kw)
-                                # folium.Marker(
-                                #     location=point,
-                                #     icon=icon,
-                                #     popup=html,
-                                #     color="pink",
-                                # ).add_to(Map)
-
-                            kwargs = {"color": "red"}
-                            intersection_centroid = Polygon(intersection).centroid
-                            if (
-                                intersection_centroid
-                            ):  # TODO: take a deep look when this shit happens
-                                intersection_centroid = [
-                                    intersection_centroid.x,
-                                    intersection_centroid.y,
-                                ]
-
-                            folium.PolyLine(
-                                [intersection_centroid, point],
-                                tooltip=f"coverage percentage: {access_point['coverage_percent']}",
-                                opacity=0.3,
-                                **kwargs,
-                            ).add_to(Map)
-
-                            folium.Polygon(
-                                locations=intersection,
-                                weight=0.3,
-                                fill_opacity=0.01,
-                                fill=True,
-                                **kwargs,
-                            ).add_to(Map)
-    return accesses_for_demands
-
-
-def is_empty(los_gsd):
-    values = los_gsd.values()
-    return all(value["GSD"] == float("inf") for value in values)
+        accesses_along_a_fligth_path = [
+            accesses_for_flights[flight.id]
+            for accesses_for_flights in result.accesses_for_demands.values()
+        ]
+        draw_accesses_on_map(flight, accesses_along_a_fligth_path, Map)
+
+
+def calculation(flights: list[Flight], demands: list[Demand]):
+    result = compute_accesses(flights, demands)
+    render_calculation(result, Map)
+    return result.accesses_for_demands
+
+
+def parallel_calculation(
+    flights: list[Flight],
+    demands: list[Demand],
+    max_workers: Optional[int] = None,
+    chunksize: int = 1,
+):
+    # Folium is only ever touched here, in this process, never by the workers
+    result = parallel_compute_accesses(flights, demands, max_workers, chunksize)
+    render_calculation(result, Map)
+    return result.accesses_for_demands
+
+
+def is_empty(los_gsd: DemandGrid):
+    return bool(np.isinf(los_gsd.gsd).all())
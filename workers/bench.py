@@ -0,0 +1,242 @@
+"""
+Offline throughput benchmark of the FOV worker.
+
+Replays synthetic flight messages through `process_FOV_warper` with in process
+stand-ins of the aio_pika message/exchange and of the asyncpg pool, and reports
+messages/sec, end to end latency percentiles and the time spent per stage.
+
+    python -m workers.bench --messages 200 --db-latency-ms 5 --workers 8
+
+With --postgres the stand-in pool is replaced by a real one built from
+`WorkerSettings`, a database on localhost unless ACCS_POSTGRES_HOST and the
+other ACCS_POSTGRES_* variables point elsewhere.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import numpy as np
+
+from workers.casing_cache import CasingCache
+from workers.config import PREFETCH_COUNT, WorkerSettings
+from workers.rabbitmq import (
+    create_pool,
+    create_tables,
+    process_FOV_warper,
+)
+
+SENSORS = [
+    {
+        "name": "bench_sensor_1",
+        "width_mm": 36,
+        "height_mm": 24,
+        "focal_length_mm": 300,
+        "image_width_px": 12400,
+    },
+    {
+        "name": "bench_sensor_2",
+        "width_mm": 69,
+        "height_mm": 54,
+        "focal_length_mm": 300,
+        "image_width_px": 14000,
+    },
+]
+
+
+class FakeMessage:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.state: Optional[str] = None
+
+    @asynccontextmanager
+    async def process(self, ignore_processed: bool = False):
+        yield
+
+    async def ack(self):
+        self.state = "ack"
+
+    async def nack(self):
+        self.state = "nack"
+
+
+class FakeExchange:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.published = 0
+
+    async def publish(self, message, routing_key: str):
+        await asyncio.sleep(self.latency)
+        self.published += 1
+
+
+class FakeConnection:
+    """Every statement costs one simulated round trip of `latency` seconds."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.round_trips = 0
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        await asyncio.sleep(self.latency)
+
+    async def execute(self, *args):
+        await self._round_trip()
+
+    async def fetchrow(self, *args):
+        await self._round_trip()
+
+    async def copy_records_to_table(self, table_name, records, columns):
+        await self._round_trip()
+
+    @asynccontextmanager
+    async def transaction(self):
+        await self._round_trip()
+        yield
+        await self._round_trip()
+
+
+class FakePool:
+    def __init__(self, latency: float, size: int = 10):
+        self.connection = FakeConnection(latency)
+        self.slots = asyncio.Semaphore(size)
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self.slots:
+            yield self.connection
+
+
+def synthetic_message(index: int, rng: np.random.Generator, path_points: int) -> bytes:
+    # A random walk of ~1km steps over northern Israel
+    start = np.array([rng.uniform(32.8, 33.2), rng.uniform(35.0, 35.4)])
+    path = start + np.cumsum(rng.normal(scale=0.01, size=(path_points, 2)), axis=0)
+    flight = {
+        "id": f"bench_flight_{index}",
+        "height_meters": float(rng.choice([3000, 5000, 10000])),
+        "speed_km_h": 500,
+        "camera_azimuth": float(rng.uniform(0, 360)),
+        "camera_elevation_start": 80,
+        "camera_elevation_end": 120,
+        "path": {"feature": {"geometry": {"coordinates": path.tolist()}}},
+    }
+    sensor = SENSORS[index % len(SENSORS)]
+    return json.dumps({"flight": flight, "sensor": sensor}).encode()
+
+
+async def run_benchmark(
+    messages: int = 100,
+    distinct_flights: Optional[int] = None,
+    path_points: int = 50,
+    db_latency: float = 0.005,
+    publish_latency: float = 0.0,
+    prefetch_count: int = PREFETCH_COUNT,
+    workers: Optional[int] = None,
+    use_casing_cache: bool = False,
+    settings: Optional[WorkerSettings] = None,
+    seed: int = 0,
+) -> dict:
+    rng = np.random.default_rng(seed)
+    distinct_flights = distinct_flights or messages
+    bodies = [
+        synthetic_message(index, rng, path_points) for index in range(distinct_flights)
+    ]
+
+    if settings is None:
+        pool = FakePool(db_latency)
+    else:
+        pool = await create_pool(settings)
+        await create_tables(pool)
+
+    exchange = FakeExchange(publish_latency)
+    stage_timings: dict[str, float] = {}
+    casing_cache = CasingCache() if use_casing_cache else None
+
+    latencies = []
+    # Stands in for the channel QoS, the broker never has more unacked deliveries
+    deliveries = asyncio.Semaphore(prefetch_count)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Start the pool processes before the clock starts
+        await asyncio.get_running_loop().run_in_executor(executor, int)
+        handler = process_FOV_warper(
+            pool, exchange, executor, prefetch_count, casing_cache, stage_timings
+        )
+
+        async def deliver(message: FakeMessage):
+            async with deliveries:
+                start = time.perf_counter()
+                await handler(message)
+                latencies.append(time.perf_counter() - start)
+
+        fake_messages = [
+            FakeMessage(bodies[index % distinct_flights]) for index in range(messages)
+        ]
+        start = time.perf_counter()
+        await asyncio.gather(*[deliver(message) for message in fake_messages])
+        elapsed = time.perf_counter() - start
+
+    if settings is not None:
+        await pool.close()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "messages": messages,
+        "acked": sum(message.state == "ack" for message in fake_messages),
+        "seconds": elapsed,
+        "messages_per_sec": messages / elapsed,
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+        "stage_seconds": stage_timings,
+    }
+
+
+def print_report(report: dict):
+    print(f"messages          {report['messages']} ({report['acked']} acked)")
+    print(f"elapsed           {report['seconds']:.2f}s")
+    print(f"throughput        {report['messages_per_sec']:.1f} msg/s")
+    print(f"latency p50       {report['latency_p50_ms']:.1f}ms")
+    print(f"latency p99       {report['latency_p99_ms']:.1f}ms")
+    # Stages overlap between messages, so these add up to more than the elapsed time
+    for stage, seconds in report["stage_seconds"].items():
+        print(f"  {stage:<15} {seconds:.2f}s total")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--distinct-flights", type=int, default=None)
+    parser.add_argument("--path-points", type=int, default=50)
+    parser.add_argument("--db-latency-ms", type=float, default=5.0)
+    parser.add_argument("--publish-latency-ms", type=float, default=0.0)
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_COUNT)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--casing-cache", action="store_true")
+    parser.add_argument(
+        "--postgres", action="store_true", help="write to the configured database"
+    )
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run_benchmark(
+            messages=args.messages,
+            distinct_flights=args.distinct_flights,
+            path_points=args.path_points,
+            db_latency=args.db_latency_ms / 1000,
+            publish_latency=args.publish_latency_ms / 1000,
+            prefetch_count=args.prefetch,
+            workers=args.workers,
+            use_casing_cache=args.casing_cache,
+            settings=WorkerSettings.from_env() if args.postgres else None,
+        )
+    )
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
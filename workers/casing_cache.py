@@ -0,0 +1,86 @@
+import hashlib
+import json
+import sqlite3
+from typing import Optional
+
+from src import LRUCache
+
+# The sensor name and the flight id/speed do not change the casing, so they are left
+# out of the key and flights sharing the same geometry share the same casing
+CASING_FLIGHT_FIELDS = (
+    "height_meters",
+    "camera_azimuth",
+    "camera_elevation_start",
+    "camera_elevation_end",
+)
+CASING_SENSOR_FIELDS = ("width_mm", "height_mm", "focal_length_mm", "image_width_px")
+
+
+def casing_cache_key(flight_params: dict, sensor_params: dict) -> str:
+    """Canonical hash of everything `create_case_for_flight_path` depends on."""
+    canonical = {
+        "path": [[float(coord) for coord in point] for point in flight_params["path"]],
+        "flight": {
+            field: float(flight_params[field]) for field in CASING_FLIGHT_FIELDS
+        },
+        "sensor": {
+            field: float(sensor_params[field]) for field in CASING_SENSOR_FIELDS
+        },
+    }
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class CasingCache:
+    """
+    Content addressed store of flight casings, an in memory LRU in front of an
+    optional SQLite file that survives restarts.
+    """
+
+    def __init__(self, path: Optional[str] = None, capacity: int = 128):
+        self.memory = LRUCache(capacity=capacity)
+        self.disk_hits = 0
+        self.disk = None
+        if path is not None:
+            self.disk = sqlite3.connect(path)
+            self.disk.execute(
+                "CREATE TABLE IF NOT EXISTS casing (key TEXT PRIMARY KEY, casing TEXT)"
+            )
+
+    def get(self, key: str) -> Optional[list[dict]]:
+        casing = self.memory.get(key)
+        if casing is not None or self.disk is None:
+            return casing
+
+        row = self.disk.execute(
+            "SELECT casing FROM casing WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        self.disk_hits += 1
+        casing = json.loads(row[0])
+        self.memory.put(key, casing)
+        return casing
+
+    def put(self, key: str, casing: list[dict]) -> None:
+        self.memory.put(key, casing)
+        if self.disk is not None:
+            with self.disk:
+                self.disk.execute(
+                    "INSERT OR REPLACE INTO casing (key, casing) VALUES (?, ?)",
+                    (key, json.dumps(casing)),
+                )
+
+    def stats(self) -> dict[str, int]:
+        memory_stats = self.memory.stats()
+        return {
+            "memory_hits": memory_stats["hits"],
+            "disk_hits": self.disk_hits,
+            "misses": memory_stats["misses"] - self.disk_hits,
+            "evictions": memory_stats["evictions"],
+        }
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()